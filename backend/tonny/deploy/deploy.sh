@@ -13,7 +13,7 @@ echo "🚀 Deploying Tonny to $SERVER_HOST..."
 echo "📦 Creating deployment package..."
 cd "$(dirname "$0")/.."
 tar czf tonny-deploy.tar.gz \
-  tonny_server.py \
+  tonny_inference_server.py \
   training_data/models/tonny-7b-merged/ \
   training_data/*.jsonl \
   deploy/tonny.service \
@@ -2,22 +2,38 @@
 """
 Tonny Inference Server
 Serves the fine-tuned Tonny-7B model via Ollama-compatible API
-Works with transformers (no MLX required, Docker-compatible)
+Runs on MLX on Apple Silicon and on transformers everywhere else (Docker-compatible)
 """
 
 import argparse
+import asyncio
+import concurrent.futures
+import copy
+import importlib.util
+import json
 import logging
 import os
-from typing import Optional, List, Dict, Any
-from contextlib import asynccontextmanager
+import platform
+from pathlib import Path
+from typing import Optional, List, Dict, Any, AsyncIterator, Protocol
+from contextlib import asynccontextmanager, contextmanager
 
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, TextIteratorStreamer
+from transformers import (
+    AutoTokenizer,
+    AutoModelForCausalLM,
+    BitsAndBytesConfig,
+)
+from transformers.cache_utils import StaticCache
+from transformers.generation.stopping_criteria import StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
+from transformers.utils import is_flash_attn_2_available
 from fastapi import FastAPI, HTTPException
 from fastapi.responses import StreamingResponse, JSONResponse
 from pydantic import BaseModel
 import uvicorn
-from threading import Thread
+from queue import Queue
+from threading import Event, Lock, Thread
 
 # Configure logging
 logging.basicConfig(
@@ -26,10 +42,63 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Global model and tokenizer
+# Global model and tokenizer, plus the backend that loaded them
+backend = None
 model = None
 tokenizer = None
 device = None
+quant_mode = None
+copy_stream = None
+
+# Micro-batching for non-streaming requests
+MAX_BATCH_SIZE = int(os.getenv("TONNY_MAX_BATCH", "8"))
+BATCH_WINDOW_S = 0.005
+batch_queue: Optional[asyncio.Queue] = None
+batch_task: Optional[asyncio.Task] = None
+
+# Preallocated KV caches, reused across requests
+MAX_CACHE_TOKENS = int(os.getenv("TONNY_MAX_CACHE_TOKENS", "2048"))
+kv_pool = None
+
+# Prompt lengths are padded up to one of these when the forward is compiled,
+# so dynamic=False sees a few shapes instead of recompiling per prompt length
+MIN_PROMPT_BUCKET = 64
+prompt_buckets: List[int] = []
+
+# Single persistent thread that runs every model.generate() call
+gen_queue: Optional[Queue] = None
+gen_worker: Optional[Thread] = None
+
+# Batch-1 decode loop replaying a captured CUDA graph (TONNY_CUDA_GRAPHS=1)
+graphed_decoder = None
+
+# The model's forward before torch.compile, for calls whose shapes vary
+eager_forward = None
+
+COMPLIANCE_SYSTEM_PROMPT = """You are Tonny, the AI assistant for Tonsurance - a parametric risk coverage protocol on TON blockchain.
+
+CRITICAL COMPLIANCE RULES:
+1. NEVER use "insurance" terminology - always use "parametric risk coverage"
+2. NEVER quote fixed APR - always check live dynamic pricing via the pricing API
+3. Use clear, friendly language with appropriate emojis
+4. Focus on automation, smart contracts, and blockchain transparency
+
+COVERAGE TYPES:
+- Stablecoin Depeg Events (USDT, USDC depeg below $0.95)
+- Smart Contract Exploits (automatic payouts on verified hacks)
+- Oracle Failures (Chainlink, Pyth network downtime)
+- Bridge Security (9 major cross-chain bridges monitored)
+
+KEY FEATURES:
+- Parametric triggers (no claims process, automatic payouts in 5-10 min)
+- Coverage NFTs (ERC-721 on TON blockchain)
+- Dynamic pricing (real-time risk-based rates)
+- Decentralized (no KYC, fully on-chain)
+- 150-250% collateralization in multi-tranche vaults
+
+When users ask about pricing, ALWAYS respond: "Let me check live rates for you! Use /quote [amount] [days] [type] to get current pricing."
+
+Be helpful, technically accurate, and compliance-focused! 🤖"""
 
 class ChatMessage(BaseModel):
     role: str
@@ -50,54 +119,172 @@ class CompletionRequest(BaseModel):
     temperature: float = 0.7
     max_tokens: int = 512
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    """Load model on startup, cleanup on shutdown"""
-    global model, tokenizer, device
+class InferenceBackend(Protocol):
+    """Model runtime behind the HTTP endpoints"""
 
-    logger.info("Loading Tonny model...")
-    model_path = os.getenv("MODEL_PATH", "models/tonny-7b-merged")
+    name: str
+
+    def load(self, model_path: str) -> None: ...
+
+    def shutdown(self) -> None: ...
+
+    def quantization_level(self) -> str: ...
+
+    async def generate(self, prompt_ids: List[int], **kwargs) -> str: ...
+
+    def stream(self, prompt_ids: List[int], **kwargs) -> AsyncIterator[bytes]: ...
+
+class KVCachePool:
+    """
+    Static KV caches allocated once and reused across requests.
+
+    Always used when the forward pass is compiled or graphed, where a fixed
+    cache shape keeps every decode step on the same compiled graph. Eager
+    runs only pool caches with TONNY_STATIC_CACHE=1: a static cache makes
+    every decode step attend over all max_cache_len positions and rules out
+    FlashAttention-2, which for typical short chats costs more than the
+    dynamic cache's allocations (served from the CUDA caching allocator's
+    free blocks once it has warmed up). Each cache
+    holds max_cache_len positions for one batch size bucket (1 and
+    MAX_BATCH_SIZE); batches are padded up to their bucket, so at most one
+    cache per bucket stays resident. run_generate() clamps max_new_tokens so
+    every lease fits; generate() never falls back to a growing cache, which
+    would recompile the compiled forward on every decode step.
+    """
+
+    def __init__(self, max_cache_len: int, buckets: List[int]):
+        self.max_cache_len = max_cache_len
+        self.buckets = sorted(set(buckets))
+        self.free: Dict[int, StaticCache] = {}
+        self.lock = Lock()
 
-    # Determine device
+    def bucket(self, batch_size: int) -> int:
+        """Smallest cache batch size that holds batch_size rows"""
+        return next((b for b in self.buckets if b >= batch_size), batch_size)
+
+    def allocate(self, batch_size: int) -> StaticCache:
+        return StaticCache(
+            config=model.config,
+            max_batch_size=batch_size,
+            max_cache_len=self.max_cache_len,
+            device=device,
+            dtype=model.dtype
+        )
+
+    def take(self, batch_size: int) -> StaticCache:
+        """Remove a cache from the pool for exclusive use, allocating if none is free"""
+        with self.lock:
+            cache = self.free.pop(batch_size, None)
+        if cache is None:
+            return self.allocate(batch_size)
+        cache.reset()
+        return cache
+
+    def preallocate(self, batch_size: int):
+        with self.lock:
+            if batch_size not in self.free:
+                self.free[batch_size] = self.allocate(batch_size)
+
+    @contextmanager
+    def lease(self, batch_size: int, total_len: int):
+        if total_len > self.max_cache_len:
+            raise ValueError(f"{total_len} tokens exceed the {self.max_cache_len}-token KV cache")
+
+        with self.lock:
+            cache = self.free.pop(batch_size, None)
+
+        if cache is None:
+            cache = self.allocate(batch_size)
+        else:
+            cache.reset()
+
+        try:
+            yield cache
+        finally:
+            with self.lock:
+                self.free.setdefault(batch_size, cache)
+
+def select_dtype(device: str) -> torch.dtype:
+    """Pick the fastest numerically safe dtype for the device"""
+    if device == "cuda" and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    if device in ("cuda", "mps"):
+        return torch.float16
+    return torch.float32
+
+def build_quantization_config(mode: str, compute_dtype: torch.dtype) -> Optional[Any]:
+    """
+    Build a weight quantization config for TONNY_QUANT.
+
+    Decode is bound by weight bandwidth, so shrinking the weights speeds up
+    every generated token: int8 halves the bytes read per step, nf4 quarters
+    them. Weights stay unquantized unless TONNY_QUANT is set (the Docker image
+    sets nf4); on A100-class GPUs weight-only int8 can be slower than fp16 for
+    prefill-heavy workloads.
+    """
+    if mode == "int8":
+        return BitsAndBytesConfig(load_in_8bit=True, llm_int8_threshold=6.0)
+    if mode == "nf4":
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=compute_dtype,
+            bnb_4bit_use_double_quant=True
+        )
+    if mode == "fp8":
+        # bitsandbytes has no fp8 path and FBGEMM's fp8 kernels (fbgemm-gpu)
+        # aren't installed, so fail here rather than inside from_pretrained
+        raise ValueError("TONNY_QUANT=fp8 is not supported; use nf4, int8 or none")
+    if mode in ("", "none"):
+        return None
+    raise ValueError(f"Unknown TONNY_QUANT mode: {mode} (expected nf4, int8 or none)")
+
+def detect_device() -> str:
+    """Pick the best available torch device"""
     if torch.cuda.is_available():
-        device = "cuda"
         logger.info("Using CUDA GPU")
-    elif hasattr(torch.backends, "mps") and torch.backends.mps.is_available():
-        device = "mps"
+        return "cuda"
+    if hasattr(torch.backends, "mps") and torch.backends.mps.is_available():
         logger.info("Using Apple Silicon MPS")
-    else:
-        device = "cpu"
-        logger.info("Using CPU (slower inference)")
+        return "mps"
+    logger.info("Using CPU (slower inference)")
+    return "cpu"
 
-    try:
-        # Load tokenizer
-        tokenizer = AutoTokenizer.from_pretrained(model_path)
-
-        # Load model with appropriate settings
-        model = AutoModelForCausalLM.from_pretrained(
-            model_path,
-            torch_dtype=torch.float16 if device != "cpu" else torch.float32,
-            device_map="auto" if device != "cpu" else None,
-            low_cpu_mem_usage=True
-        )
+def select_backend(device: str) -> "InferenceBackend":
+    """
+    MLX on Apple Silicon when it is installed, transformers otherwise.
 
-        if device == "cpu":
-            model = model.to(device)
+    TONNY_BACKEND=mlx|transformers overrides the choice.
+    """
+    choice = os.getenv("TONNY_BACKEND", "auto").lower()
+    if choice == "mlx":
+        return MLXBackend()
+    if choice == "transformers":
+        return TransformersBackend()
 
-        model.eval()
-        logger.info(f"Model loaded successfully on {device}")
+    mlx_available = importlib.util.find_spec("mlx_lm") is not None
+    if device == "mps" and platform.machine() == "arm64" and mlx_available:
+        return MLXBackend()
+    return TransformersBackend()
 
-    except Exception as e:
-        logger.error(f"Failed to load model: {e}")
-        raise
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Load model on startup, cleanup on shutdown"""
+    global backend, device
+
+    logger.info("Loading Tonny model...")
+    model_path = os.getenv("MODEL_PATH", "models/tonny-7b-merged")
+
+    device = detect_device()
+    backend = select_backend(device)
+    logger.info(f"Using {backend.name} backend")
+    backend.load(model_path)
 
     yield
 
     # Cleanup
     logger.info("Shutting down, cleaning up model...")
-    del model
-    del tokenizer
-    torch.cuda.empty_cache() if torch.cuda.is_available() else None
+    backend.shutdown()
 
 app = FastAPI(
     title="Tonny Inference Server",
@@ -106,68 +293,836 @@ app = FastAPI(
     lifespan=lifespan
 )
 
-def format_chat_prompt(messages: List[ChatMessage]) -> str:
-    """Format chat messages into a prompt"""
-    formatted = ""
-    for msg in messages:
-        if msg.role == "system":
-            formatted += f"System: {msg.content}\n\n"
-        elif msg.role == "user":
-            formatted += f"User: {msg.content}\n\n"
-        elif msg.role == "assistant":
-            formatted += f"Assistant: {msg.content}\n\n"
-
-    # Add final assistant prompt
-    formatted += "Assistant:"
-    return formatted
-
-def generate_response(
-    prompt: str,
+def encode_prompt(prompt: str) -> List[int]:
+    """
+    Tokenize a completion prompt.
+
+    Plain text is wrapped in the chat format with the compliance system
+    prompt when TONNY_WRAP_GENERATE_PROMPTS=1 (the default on MLX, as the old
+    Flask server did); transformers keeps raw completions by default.
+    """
+    default = "1" if backend is not None and backend.name == "mlx" else "0"
+    wrap = os.getenv("TONNY_WRAP_GENERATE_PROMPTS", default) == "1"
+
+    # The OCaml bot may send an already formatted '<s>[INST] ... [/INST]' prompt
+    if "[INST]" in prompt or not wrap:
+        return encode_raw(prompt)
+    return encode_chat([ChatMessage(role="user", content=prompt)])
+
+def encode_raw(prompt: str) -> List[int]:
+    """Tokenize a prompt verbatim, adding BOS only if the text doesn't already start with it"""
+    bos = tokenizer.bos_token
+    has_bos = bool(bos) and prompt.startswith(bos)
+    return tokenizer.encode(prompt, add_special_tokens=not has_bos)
+
+def encode_chat(messages: List[ChatMessage]) -> List[int]:
+    """Tokenize chat messages with the model's own chat template"""
+    # The [INST] template only accepts alternating user/assistant turns. Treat
+    # any other role (e.g. tool output) as user input and merge consecutive
+    # turns from the same side, as the old hand-built prompt tolerated both
+    msgs: List[Dict[str, str]] = []
+    for m in messages:
+        if m.role == "system":
+            continue
+        role = "assistant" if m.role == "assistant" else "user"
+        if msgs and msgs[-1]["role"] == role:
+            msgs[-1]["content"] = f"{msgs[-1]['content']}\n\n{m.content}"
+        else:
+            msgs.append({"role": role, "content": m.content})
+
+    # Mistral's [INST] template has no system role; fold system messages into
+    # the first user turn, matching the fine-tuning data
+    system = "\n\n".join(m.content for m in messages if m.role == "system")
+    system = system or COMPLIANCE_SYSTEM_PROMPT
+    if msgs and msgs[0]["role"] == "user":
+        msgs[0]["content"] = f"{system}\n\n{msgs[0]['content']}"
+    else:
+        msgs.insert(0, {"role": "user", "content": system})
+
+    return tokenizer.apply_chat_template(msgs, add_generation_prompt=True)
+
+def to_device_inputs(batch_ids: List[List[int]]) -> Dict[str, torch.Tensor]:
+    """Left-pad token id lists into a batch and copy it to the model device"""
+    longest = max(len(ids) for ids in batch_ids)
+    bucket = next((b for b in prompt_buckets if b >= longest), None)
+    if bucket is None:
+        enc = tokenizer.pad({"input_ids": batch_ids}, return_tensors="pt")
+    else:
+        enc = tokenizer.pad(
+            {"input_ids": batch_ids},
+            padding="max_length",
+            max_length=bucket,
+            return_tensors="pt"
+        )
+
+    if copy_stream is None:
+        return {k: v.to(device) for k, v in enc.items()}
+
+    # Pinned, non-blocking copy on a side stream; the compute stream waits on
+    # it instead of the host blocking on a synchronous copy
+    with torch.cuda.stream(copy_stream):
+        inputs = {
+            k: v.pin_memory().to(device, non_blocking=True)
+            for k, v in enc.items()
+        }
+    compute_stream = torch.cuda.current_stream()
+    compute_stream.wait_stream(copy_stream)
+    for v in inputs.values():
+        v.record_stream(compute_stream)
+    return inputs
+
+def build_gen_config(
     temperature: float = 0.7,
     max_tokens: int = 512,
     top_p: float = 0.9,
-    stream: bool = False
+    top_k: int = 50
+) -> Dict[str, Any]:
+    """Build model.generate() keyword arguments for a request"""
+    gen_config = {
+        "max_new_tokens": max_tokens,
+        "pad_token_id": tokenizer.eos_token_id,
+        "use_cache": True,
+        "output_attentions": False,
+        "output_hidden_states": False,
+        "return_dict_in_generate": False,
+    }
+
+    if temperature <= 0:
+        # Greedy: clear the sampling knobs so generate() builds no logits warpers
+        gen_config.update({
+            "do_sample": False,
+            "num_beams": 1,
+            "temperature": None,
+            "top_p": None,
+            "top_k": None,
+        })
+    else:
+        gen_config.update({
+            "do_sample": True,
+            "temperature": temperature,
+            "top_p": top_p,
+            "top_k": top_k,
+        })
+
+    return gen_config
+
+def sample_logits(
+    logits: torch.Tensor,
+    temperature: torch.Tensor,
+    top_p: torch.Tensor,
+    top_k: int
+) -> torch.Tensor:
+    """
+    Temperature, top-k and top-p sampling from [1, vocab] logits in pure tensor ops.
+
+    Sampling uses the exponential race (argmax of p / Exp(1) noise) rather
+    than torch.multinomial, so the sampler itself never syncs with the host
+    and compiles into a couple of fused kernels. The caller still syncs once
+    per token to read the id back for EOS checks and streaming. temperature
+    and top_p are passed as device tensors so new values don't trigger
+    recompilation.
+    """
+    logits = logits.float() / temperature
+    kth = torch.topk(logits, top_k).values[..., -1, None]
+    logits = logits.masked_fill(logits < kth, float("-inf"))
+
+    sorted_logits, sorted_idx = torch.sort(logits, descending=True)
+    sorted_probs = sorted_logits.softmax(dim=-1)
+    # Drop tokens once the mass before them exceeds top_p
+    remove = sorted_probs.cumsum(dim=-1) - sorted_probs > top_p
+    sorted_probs = sorted_probs.masked_fill(remove, 0.0)
+
+    noise = torch.empty_like(sorted_probs).exponential_(1)
+    choice = torch.argmax(sorted_probs / noise, dim=-1, keepdim=True)
+    return sorted_idx.gather(-1, choice).view(-1)
+
+fused_sample_logits = torch.compile(sample_logits, dynamic=False)
+
+def make_token_sampler(gen_config: Dict[str, Any]):
+    """
+    Build a per-request logits -> next token id function.
+
+    Only the graphed decode loop (TONNY_CUDA_GRAPHS=1) samples with this;
+    every other path samples inside model.generate().
+    """
+    if not gen_config["do_sample"]:
+        return lambda logits: logits.argmax(dim=-1)
+
+    temperature = torch.tensor(gen_config["temperature"], device=device)
+    top_p = torch.tensor(gen_config["top_p"], device=device)
+    top_k = gen_config["top_k"] or model.config.vocab_size
+    return lambda logits: fused_sample_logits(logits, temperature, top_p, top_k)
+
+class GraphedDecoder:
+    """
+    Batch-1 decode loop that replays a captured CUDA graph for every token.
+
+    Prefill runs the uncompiled forward since prompt lengths vary. Each decode
+    step after that has identical shapes over the pool's batch-1 static
+    cache, which the decoder takes over, so the single-token forward is
+    captured once and replayed, skipping Python dispatch and per-kernel
+    launch overhead.
+    """
+
+    def __init__(self, cache: StaticCache):
+        self.max_cache_len = cache.max_cache_len
+        self.cache = cache
+        self.input_ids = torch.zeros((1, 1), dtype=torch.long, device=device)
+        self.cache_position = torch.zeros((1,), dtype=torch.long, device=device)
+        self.graph = torch.cuda.CUDAGraph()
+        self.logits = None
+
+    def forward_step(self) -> torch.Tensor:
+        return model(
+            input_ids=self.input_ids,
+            position_ids=self.cache_position.unsqueeze(0),
+            cache_position=self.cache_position,
+            past_key_values=self.cache,
+            use_cache=True
+        ).logits
+
+    def capture(self):
+        # Warm up on a side stream before capturing, as CUDA graphs require.
+        # The first run compiles the step if the forward is compiled
+        side = torch.cuda.Stream()
+        side.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(side):
+            for _ in range(3):
+                self.forward_step()
+        torch.cuda.current_stream().wait_stream(side)
+
+        with torch.cuda.graph(self.graph):
+            self.logits = self.forward_step()
+        self.cache.reset()
+
+        # Compile the fused sampler now rather than on the first request
+        make_token_sampler(build_gen_config())(self.logits[:, -1])
+
+    def fits(self, prompt_len: int, max_new_tokens: int) -> bool:
+        return prompt_len + max_new_tokens <= self.max_cache_len
+
+    def generate(self, input_ids: torch.Tensor, gen_config: Dict[str, Any]) -> torch.Tensor:
+        """Same contract as model.generate(): returns prompt + generated ids"""
+        streamer = gen_config.get("streamer")
+        stopping_criteria = gen_config.get("stopping_criteria")
+        sample = make_token_sampler(gen_config)
+        prompt_len = input_ids.shape[1]
+        tokens: List[int] = []
+
+        self.cache.reset()
+        if streamer is not None:
+            streamer.put(input_ids)
+
+        logits = eager_forward(
+            input_ids=input_ids,
+            cache_position=torch.arange(prompt_len, device=device),
+            past_key_values=self.cache,
+            use_cache=True
+        ).logits[:, -1]
+
+        for step in range(gen_config["max_new_tokens"]):
+            next_token = sample(logits)
+            token = next_token.item()
+            tokens.append(token)
+            if streamer is not None:
+                streamer.put(next_token)
+            if token == tokenizer.eos_token_id:
+                break
+            if stopping_criteria is not None and stopping_criteria(input_ids, logits).any():
+                break
+
+            self.input_ids.copy_(next_token.view(1, 1))
+            self.cache_position.fill_(prompt_len + step)
+            self.graph.replay()
+            logits = self.logits[:, -1]
+
+        if streamer is not None:
+            streamer.end()
+
+        generated = torch.tensor([tokens], dtype=input_ids.dtype, device=device)
+        return torch.cat([input_ids, generated], dim=1)
+
+def run_generate(inputs: Dict[str, torch.Tensor], gen_config: Dict[str, Any]) -> torch.Tensor:
+    """Run generation under inference mode, on a pooled KV cache when static caches are on"""
+    batch_size, prompt_len = inputs["input_ids"].shape
+
+    # Static caches can't grow, so cap the output at what fits after the
+    # (padded) prompt; check_prompt_length() keeps at least one slot free
+    if kv_pool is not None:
+        max_new_tokens = min(gen_config["max_new_tokens"], kv_pool.max_cache_len - prompt_len)
+        gen_config = {**gen_config, "max_new_tokens": max_new_tokens}
+    total_len = prompt_len + gen_config["max_new_tokens"]
+
+    # Inference mode is thread-local, so callers on worker threads get it here
+    with torch.inference_mode():
+        if graphed_decoder is not None and batch_size == 1:
+            # The graphed loop attends to every cached position, so drop any
+            # bucket padding first
+            input_ids = inputs["input_ids"][:, inputs["attention_mask"][0].bool()]
+            if graphed_decoder.fits(input_ids.shape[1], gen_config["max_new_tokens"]):
+                return graphed_decoder.generate(input_ids, gen_config)
+
+        if kv_pool is None:
+            return model.generate(**inputs, **gen_config)
+
+        # Pad the batch up to its cache bucket with copies of the first row;
+        # the extra rows are dropped from the output
+        cache_batch = kv_pool.bucket(batch_size)
+        if cache_batch > batch_size:
+            inputs = {
+                k: torch.cat([v, v[:1].expand(cache_batch - batch_size, -1)])
+                for k, v in inputs.items()
+            }
+
+        with kv_pool.lease(cache_batch, total_len) as cache:
+            return model.generate(**inputs, **gen_config, past_key_values=cache)[:batch_size]
+
+def generation_worker():
+    """Run queued generation jobs one after another on this thread"""
+    while (job := gen_queue.get()) is not None:
+        inputs, gen_config, result = job
+        if not result.set_running_or_notify_cancel():
+            continue
+        try:
+            result.set_result(run_generate(inputs, gen_config))
+        except Exception as e:
+            result.set_exception(e)
+            # Unblock a streaming consumer; it re-raises from the future
+            streamer = gen_config.get("streamer")
+            if streamer is not None:
+                streamer.end()
+
+def submit_generation(
+    inputs: Dict[str, torch.Tensor],
+    gen_config: Dict[str, Any]
+) -> concurrent.futures.Future:
+    """
+    Queue a model.generate() call on the generation worker.
+
+    Inputs copied by to_device_inputs() are ordered on the compute stream,
+    which the worker also issues generate() on, so no host sync is needed.
+    """
+    result = concurrent.futures.Future()
+    gen_queue.put((inputs, gen_config, result))
+    return result
+
+async def generate_batch(prompts: List[List[int]], gen_config: Dict[str, Any]) -> List[str]:
+    """Run one padded model.generate() over a batch of tokenized prompts"""
+    inputs = to_device_inputs(prompts)
+    prompt_len = inputs["input_ids"].shape[1]
+
+    outputs = await asyncio.wrap_future(submit_generation(inputs, gen_config))
+
+    return tokenizer.batch_decode(outputs[:, prompt_len:], skip_special_tokens=True)
+
+async def batch_scheduler():
+    """Coalesce queued requests arriving within a short window into batches"""
+    loop = asyncio.get_running_loop()
+
+    while True:
+        batch = [await batch_queue.get()]
+        deadline = loop.time() + BATCH_WINDOW_S
+        while len(batch) < MAX_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(batch_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Requests can only share a generate() call if their settings match
+        groups: Dict[tuple, list] = {}
+        for prompt, future, gen_config in batch:
+            key = tuple(sorted(gen_config.items()))
+            groups.setdefault(key, []).append((prompt, future))
+
+        for key, items in groups.items():
+            prompts = [prompt for prompt, _ in items]
+            try:
+                responses = await generate_batch(prompts, dict(key))
+            except Exception as e:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), response in zip(items, responses):
+                if not future.done():
+                    future.set_result(response)
+
+def check_prompt_length(prompt_ids: List[int]):
+    """Reject prompts that leave no room in the static KV cache"""
+    if kv_pool is not None and len(prompt_ids) >= MAX_CACHE_TOKENS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Prompt is {len(prompt_ids)} tokens; the limit is {MAX_CACHE_TOKENS - 1}"
+        )
+
+async def generate_response(
+    prompt_ids: List[int],
+    temperature: float = 0.7,
+    max_tokens: int = 512,
+    top_p: float = 0.9
+) -> str:
+    """Generate a full completion via the batch scheduler"""
+    if model is None or tokenizer is None or batch_queue is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+
+    future = asyncio.get_running_loop().create_future()
+    await batch_queue.put((prompt_ids, future, build_gen_config(temperature, max_tokens, top_p)))
+    return await future
+
+class StopOnEvent(StoppingCriteria):
+    """Ends generation once the event is set, e.g. when a streaming client disconnects"""
+
+    def __init__(self, event: Event):
+        self.event = event
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full(
+            (input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device
+        )
+
+class TokenIdStreamer(BaseStreamer):
+    """
+    Hands raw generated token ids from the generation worker to the event loop.
+
+    Ids are buffered and handed over chunk_tokens at a time, so the event loop
+    is woken (and an SSE frame sent) once per chunk rather than per token. The
+    first token is flushed immediately to keep time-to-first-token low.
+    """
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        chunk_tokens: int = 4,
+        skip_prompt: bool = True
+    ):
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.chunk_tokens = chunk_tokens
+        self.buffer: List[int] = []
+        self.skip_prompt = skip_prompt
+        self.flushed_first = False
+
+    def put(self, value: torch.Tensor):
+        # The first call from generate() carries the prompt
+        if self.skip_prompt:
+            self.skip_prompt = False
+            return
+        self.add(value.reshape(-1).tolist())
+
+    def add(self, ids: List[int]):
+        self.buffer.extend(ids)
+        if not self.flushed_first or len(self.buffer) >= self.chunk_tokens:
+            self.flushed_first = True
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, self.buffer)
+            self.buffer = []
+
+    def end(self):
+        self.flush()
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+    async def __aiter__(self):
+        while (ids := await self.queue.get()) is not None:
+            yield ids
+
+class IncrementalDecoder:
+    """
+    Detokenize a growing token sequence without re-decoding all of it.
+
+    Only the ids since the last emitted boundary are decoded each step, and
+    output is held back while it ends in a partial UTF-8 sequence (decoded as
+    U+FFFD), so every emitted chunk is complete code points.
+    """
+
+    def __init__(self):
+        self.ids: List[int] = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def add(self, new_ids: List[int]) -> bytes:
+        self.ids.extend(new_ids)
+        prefix_text = tokenizer.decode(
+            self.ids[self.prefix_offset:self.read_offset], skip_special_tokens=True
+        )
+        new_text = tokenizer.decode(self.ids[self.prefix_offset:], skip_special_tokens=True)
+
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.ids)
+            return new_text[len(prefix_text):].encode()
+        return b""
+
+async def stream_response(
+    prompt_ids: List[int],
+    temperature: float = 0.7,
+    max_tokens: int = 512,
+    top_p: float = 0.9
 ):
-    """Generate text from the model"""
+    """Generate text from the model, yielding UTF-8 chunks as they are decoded"""
     global model, tokenizer, device
 
     if model is None or tokenizer is None:
         raise HTTPException(status_code=503, detail="Model not loaded")
 
-    # Tokenize input
-    inputs = tokenizer(prompt, return_tensors="pt").to(device)
+    inputs = to_device_inputs([prompt_ids])
 
     # Generation config
-    gen_config = {
-        "max_new_tokens": max_tokens,
-        "temperature": temperature,
-        "top_p": top_p,
-        "do_sample": temperature > 0,
-        "pad_token_id": tokenizer.eos_token_id,
-    }
+    gen_config = build_gen_config(temperature, max_tokens, top_p)
 
-    if stream:
-        # Streaming generation
-        streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
-        gen_config["streamer"] = streamer
+    streamer = TokenIdStreamer(asyncio.get_running_loop())
+    gen_config["streamer"] = streamer
 
-        # Generate in thread
-        thread = Thread(target=model.generate, kwargs={**inputs, **gen_config})
-        thread.start()
+    # Stop generating if the client goes away mid-stream
+    stop = Event()
+    gen_config["stopping_criteria"] = StoppingCriteriaList([StopOnEvent(stop)])
 
-        # Stream tokens
-        for text in streamer:
-            if text:
-                yield text
+    result = submit_generation(inputs, gen_config)
 
-        thread.join()
-    else:
-        # Non-streaming generation
-        with torch.no_grad():
-            outputs = model.generate(**inputs, **gen_config)
+    # Stream UTF-8 chunks as token ids arrive
+    decoder = IncrementalDecoder()
+    try:
+        async for ids in streamer:
+            chunk = decoder.add(ids)
+            if chunk:
+                yield chunk
+    finally:
+        stop.set()
+
+    # Surface any generation error
+    await asyncio.wrap_future(result)
 
-        response = tokenizer.decode(outputs[0][inputs['input_ids'].shape[1]:], skip_special_tokens=True)
-        return response
+class TransformersBackend:
+    """PyTorch/transformers runtime for CUDA, MPS and CPU hosts"""
+
+    name = "transformers"
+
+    def load(self, model_path: str):
+        global model, tokenizer, quant_mode, copy_stream, eager_forward
+        global batch_queue, batch_task, kv_pool, gen_queue, gen_worker, graphed_decoder
+
+        # Let residual fp32 matmuls run on TF32 tensor cores
+        if device == "cuda":
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.set_float32_matmul_precision("high")
+
+        try:
+            # Load the Rust-backed fast tokenizer
+            tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
+            if not tokenizer.is_fast:
+                raise RuntimeError(f"No fast tokenizer available for {model_path}")
+
+            # Left-pad so batched prompts all end where generation starts
+            tokenizer.padding_side = "left"
+            if tokenizer.pad_token is None:
+                tokenizer.pad_token = tokenizer.eos_token
+
+            # Load model with appropriate settings. A 7B model fits on one
+            # device, so pin every module there instead of letting accelerate
+            # shard it and dispatch through per-layer hooks
+            load_kwargs = {
+                "torch_dtype": select_dtype(device),
+                "device_map": {"": device},
+                "low_cpu_mem_usage": True,
+            }
+
+            # Weight quantization is CUDA-only
+            if device == "cuda":
+                quant_mode = os.getenv("TONNY_QUANT", "none").lower()
+                quant_config = build_quantization_config(quant_mode, load_kwargs["torch_dtype"])
+                if quant_config is not None:
+                    load_kwargs["quantization_config"] = quant_config
+                    load_kwargs["device_map"] = {"": 0}
+                    logger.info(f"Quantizing weights to {quant_mode}")
+                else:
+                    quant_mode = None
+
+            use_cuda_graphs = os.getenv("TONNY_CUDA_GRAPHS", "0") == "1" and device == "cuda"
+            use_compile = os.getenv("TONNY_COMPILE", "0") == "1" and device != "cpu"
+            static_caches = (
+                use_cuda_graphs
+                or use_compile
+                or os.getenv("TONNY_STATIC_CACHE", "0") == "1"
+            )
+
+            # Prefer FlashAttention-2 when the package is installed, else PyTorch
+            # SDPA. FlashAttention-2 doesn't support StaticCache, so static
+            # caches always run on SDPA
+            if device == "cuda" and is_flash_attn_2_available() and not static_caches:
+                attn_implementation = "flash_attention_2"
+            else:
+                attn_implementation = "sdpa"
+            logger.info(f"Using {attn_implementation} attention")
+
+            model = AutoModelForCausalLM.from_pretrained(
+                model_path,
+                attn_implementation=attn_implementation,
+                **load_kwargs
+            )
+
+            param_device = next(model.parameters()).device
+            if param_device.type != device:
+                raise RuntimeError(f"Model loaded on {param_device}, expected {device}")
+
+            model.eval()
+            logger.info(f"Model loaded successfully on {device}")
+
+            # Dedicated stream for host-to-device input copies
+            if device == "cuda":
+                copy_stream = torch.cuda.Stream()
+
+            # Static caches keep every decode step the same shape, so a compiled
+            # forward is reused for each token instead of recompiling as the
+            # sequence grows. Eager runs keep HF's dynamic cache unless
+            # TONNY_STATIC_CACHE=1 (see KVCachePool)
+            if static_caches:
+                kv_pool = KVCachePool(MAX_CACHE_TOKENS, [1, MAX_BATCH_SIZE])
+                model.generation_config.max_length = MAX_CACHE_TOKENS
+
+            gen_queue = Queue()
+            gen_worker = Thread(target=generation_worker, name="tonny-generate", daemon=True)
+            gen_worker.start()
+
+            # Compile the forward pass (opt-in; first compile takes ~1 min).
+            # Inductor's own CUDA graphs can't be nested inside the decode graph
+            # captured below, so keep compilation to kernel fusion in that case
+            eager_forward = model.forward
+            if use_compile:
+                logger.info("Compiling model forward with torch.compile...")
+                model.forward = torch.compile(
+                    model.forward,
+                    mode="default" if use_cuda_graphs else "reduce-overhead",
+                    fullgraph=False,
+                    dynamic=False
+                )
+
+                # Power-of-two prompt buckets, each compiled once per cache batch size
+                size = MIN_PROMPT_BUCKET
+                while size < MAX_CACHE_TOKENS:
+                    prompt_buckets.append(size)
+                    size *= 2
+                # One prefill per bucket plus one decode step per cache batch size,
+                # and the graphed decode step, which is called without a mask
+                cache_batches = sorted({1, MAX_BATCH_SIZE})
+                torch._dynamo.config.cache_size_limit = max(
+                    torch._dynamo.config.cache_size_limit,
+                    len(cache_batches) * (len(prompt_buckets) + 1) + int(use_cuda_graphs)
+                )
+
+                # Warm up every bucket on the generation worker, where the compiled
+                # graphs will be replayed, so no request pays the compile cost
+                warmup_ids = encode_prompt("warmup")
+                for batch_size in cache_batches:
+                    for length in prompt_buckets:
+                        ids = (warmup_ids * length)[:length]
+                        submit_generation(
+                            to_device_inputs([ids] * batch_size),
+                            build_gen_config(temperature=0, max_tokens=4)
+                        ).result()
+                logger.info(f"Model compiled and warmed up for prompt buckets {prompt_buckets}")
+
+            # The graphed decoder owns the batch-1 cache; batch-1 requests only
+            # lease one from the pool when graph capture is off or failed.
+            # capture() runs the decode step before capturing it, which also
+            # compiles that one shape when TONNY_COMPILE=1
+            if use_cuda_graphs:
+                try:
+                    decoder = GraphedDecoder(kv_pool.take(1))
+                    with torch.inference_mode():
+                        decoder.capture()
+                    graphed_decoder = decoder
+                    logger.info("Captured CUDA graph for the decode step")
+                except Exception as e:
+                    logger.warning(f"CUDA graph capture failed ({e}), using generate()")
+
+            # Allocate the single-request KV cache up front
+            if kv_pool is not None and graphed_decoder is None:
+                kv_pool.preallocate(1)
+
+        except Exception as e:
+            logger.error(f"Failed to load model: {e}")
+            raise
+
+        batch_queue = asyncio.Queue()
+        batch_task = asyncio.create_task(batch_scheduler())
+
+    def shutdown(self):
+        global model, tokenizer, kv_pool, graphed_decoder, eager_forward
+
+        batch_task.cancel()
+        gen_queue.put(None)
+        gen_worker.join()
+        kv_pool = None
+        prompt_buckets.clear()
+        graphed_decoder = None
+        eager_forward = None
+        model = None
+        tokenizer = None
+        torch.cuda.empty_cache() if torch.cuda.is_available() else None
+
+    def quantization_level(self) -> str:
+        if quant_mode:
+            return quant_mode
+        return {torch.bfloat16: "bf16", torch.float16: "fp16"}.get(model.dtype, "fp32")
+
+    async def generate(self, prompt_ids: List[int], **kwargs) -> str:
+        check_prompt_length(prompt_ids)
+        return await generate_response(prompt_ids, **kwargs)
+
+    def stream(self, prompt_ids: List[int], **kwargs) -> AsyncIterator[bytes]:
+        # Checked here rather than in stream_response so the 400 is raised
+        # before the streaming response starts
+        check_prompt_length(prompt_ids)
+        return stream_response(prompt_ids, **kwargs)
+
+class MLXBackend:
+    """
+    MLX runtime for Apple Silicon, 2-3x faster than transformers on MPS.
+
+    Generation runs on a single executor thread. The KV cache for the default
+    compliance system prompt is prefilled once at load and copied into every
+    request that starts with it, so only the user turn is prefilled.
+    """
+
+    name = "mlx"
+
+    def __init__(self):
+        self.model_path = None
+        self.prefix_ids: List[int] = []
+        self.prefix_cache = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="tonny-mlx"
+        )
+
+    def load(self, model_path: str):
+        global model, tokenizer
+        from mlx_lm import load
+
+        try:
+            model, tokenizer = load(model_path)
+            self.model_path = model_path
+            logger.info("Model loaded successfully with MLX")
+
+            self.executor.submit(self.build_prefix_cache).result()
+        except Exception as e:
+            logger.error(f"Failed to load model: {e}")
+            raise
+
+    def build_prefix_cache(self):
+        """Prefill the token prefix shared by all default-system-prompt chats"""
+        import mlx.core as mx
+        from mlx_lm.models.cache import make_prompt_cache
+
+        a = encode_chat([ChatMessage(role="user", content="a")])
+        b = encode_chat([ChatMessage(role="user", content="b")])
+        n = 0
+        while n < min(len(a), len(b)) and a[n] == b[n]:
+            n += 1
+        self.prefix_ids = a[:n]
+
+        self.prefix_cache = make_prompt_cache(model)
+        model(mx.array(self.prefix_ids)[None], cache=self.prefix_cache)
+        mx.eval([c.state for c in self.prefix_cache])
+        logger.info(f"Cached system prompt prefix ({n} tokens)")
+
+    def decode(
+        self,
+        prompt_ids: List[int],
+        temperature: float,
+        max_tokens: int,
+        top_p: float,
+        on_token,
+        stop: Optional[Event] = None
+    ):
+        """Run the MLX decode loop, calling on_token with each generated id"""
+        import mlx.core as mx
+        from mlx_lm.generate import generate_step
+        from mlx_lm.sample_utils import make_sampler
+
+        # Reuse the cached prefill when the prompt starts with the default
+        # system prompt; anything else falls back to a full prefill
+        cache = None
+        n = len(self.prefix_ids)
+        if len(prompt_ids) > n and prompt_ids[:n] == self.prefix_ids:
+            cache = copy.deepcopy(self.prefix_cache)
+            prompt_ids = prompt_ids[n:]
+
+        for token, _ in generate_step(
+            mx.array(prompt_ids),
+            model,
+            max_tokens=max_tokens,
+            sampler=make_sampler(temp=temperature, top_p=top_p),
+            prompt_cache=cache
+        ):
+            if token in tokenizer.eos_token_ids or (stop is not None and stop.is_set()):
+                break
+            on_token(token)
+
+    def shutdown(self):
+        global model, tokenizer
+
+        self.executor.shutdown(wait=True)
+        self.prefix_cache = None
+        model = None
+        tokenizer = None
+
+    def quantization_level(self) -> str:
+        config = json.loads((Path(self.model_path) / "config.json").read_text())
+        bits = config.get("quantization", {}).get("bits")
+        return f"{bits}bit" if bits else "fp16"
+
+    async def generate(
+        self,
+        prompt_ids: List[int],
+        temperature: float = 0.7,
+        max_tokens: int = 512,
+        top_p: float = 0.9
+    ) -> str:
+        tokens: List[int] = []
+        await asyncio.get_running_loop().run_in_executor(
+            self.executor,
+            lambda: self.decode(prompt_ids, temperature, max_tokens, top_p, tokens.append)
+        )
+        return tokenizer.decode(tokens, skip_special_tokens=True).strip()
+
+    async def stream(
+        self,
+        prompt_ids: List[int],
+        temperature: float = 0.7,
+        max_tokens: int = 512,
+        top_p: float = 0.9
+    ) -> AsyncIterator[bytes]:
+        loop = asyncio.get_running_loop()
+        streamer = TokenIdStreamer(loop, skip_prompt=False)
+        stop = Event()
+
+        def run():
+            try:
+                self.decode(
+                    prompt_ids, temperature, max_tokens, top_p,
+                    lambda token: streamer.add([token]), stop
+                )
+            finally:
+                streamer.end()
+
+        result = loop.run_in_executor(self.executor, run)
+
+        decoder = IncrementalDecoder()
+        try:
+            async for ids in streamer:
+                chunk = decoder.add(ids)
+                if chunk:
+                    yield chunk
+            await result
+        finally:
+            # Stops the decode loop early if the client disconnected mid-stream
+            stop.set()
 
 @app.get("/health")
 async def health_check():
@@ -175,6 +1130,7 @@ async def health_check():
     return {
         "status": "healthy",
         "model_loaded": model is not None,
+        "backend": backend.name if backend else "unknown",
         "device": str(device) if device else "unknown"
     }
 
@@ -200,10 +1156,10 @@ async def list_models():
                 "size": 7_000_000_000,
                 "details": {
                     "parent_model": "mistral-7b",
-                    "format": "transformers",
+                    "format": backend.name,
                     "family": "mistral",
                     "parameter_size": "7B",
-                    "quantization_level": "fp16"
+                    "quantization_level": backend.quantization_level()
                 }
             }
         ]
@@ -213,31 +1169,29 @@ async def list_models():
 async def chat(request: ChatRequest):
     """Chat completion endpoint (Ollama-compatible)"""
     try:
-        # Format prompt from messages
-        prompt = format_chat_prompt(request.messages)
+        # Apply the model's chat template
+        prompt_ids = encode_chat(request.messages)
 
         if request.stream:
             # Stream response
             async def generate_stream():
-                for chunk in generate_response(
-                    prompt,
+                async for chunk in backend.stream(
+                    prompt_ids,
                     temperature=request.temperature,
                     max_tokens=request.max_tokens,
-                    top_p=request.top_p,
-                    stream=True
+                    top_p=request.top_p
                 ):
-                    yield f"data: {chunk}\n\n"
-                yield "data: [DONE]\n\n"
+                    yield b"data: " + chunk + b"\n\n"
+                yield b"data: [DONE]\n\n"
 
             return StreamingResponse(generate_stream(), media_type="text/event-stream")
         else:
             # Non-streaming response
-            response = generate_response(
-                prompt,
+            response = await backend.generate(
+                prompt_ids,
                 temperature=request.temperature,
                 max_tokens=request.max_tokens,
-                top_p=request.top_p,
-                stream=False
+                top_p=request.top_p
             )
 
             return {
@@ -250,6 +1204,8 @@ async def chat(request: ChatRequest):
                 "done": True
             }
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Chat error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -258,26 +1214,26 @@ async def chat(request: ChatRequest):
 async def generate(request: CompletionRequest):
     """Text generation endpoint (Ollama-compatible)"""
     try:
+        prompt_ids = encode_prompt(request.prompt)
+
         if request.stream:
             # Stream response
             async def generate_stream():
-                for chunk in generate_response(
-                    request.prompt,
+                async for chunk in backend.stream(
+                    prompt_ids,
                     temperature=request.temperature,
-                    max_tokens=request.max_tokens,
-                    stream=True
+                    max_tokens=request.max_tokens
                 ):
-                    yield f"data: {chunk}\n\n"
-                yield "data: [DONE]\n\n"
+                    yield b"data: " + chunk + b"\n\n"
+                yield b"data: [DONE]\n\n"
 
             return StreamingResponse(generate_stream(), media_type="text/event-stream")
         else:
             # Non-streaming response
-            response = generate_response(
-                request.prompt,
+            response = await backend.generate(
+                prompt_ids,
                 temperature=request.temperature,
-                max_tokens=request.max_tokens,
-                stream=False
+                max_tokens=request.max_tokens
             )
 
             return {
@@ -287,13 +1243,15 @@ async def generate(request: CompletionRequest):
                 "done": True
             }
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Generation error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 def main():
     parser = argparse.ArgumentParser(description="Tonny Inference Server")
-    parser.add_argument("--host", default="0.0.0.0", help="Host to bind to")
+    parser.add_argument("--host", default="127.0.0.1", help="Host to bind to")
     parser.add_argument("--port", type=int, default=11434, help="Port to bind to")
     parser.add_argument("--model-path", default="models/tonny-7b-merged", help="Path to model")
 
@@ -308,7 +1266,9 @@ def main():
         host=args.host,
         port=args.port,
         log_level="info",
-        access_log=True
+        access_log=True,
+        loop="uvloop",
+        http="httptools"
     )
 
 if __name__ == "__main__":